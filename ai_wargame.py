@@ -1,17 +1,32 @@
 from __future__ import annotations
 import argparse
 import copy
-from datetime import datetime
+import os
 from enum import Enum
-from dataclasses import dataclass, field
-from time import sleep
-from typing import Tuple, TypeVar, Type, Iterable, ClassVar
+from dataclasses import dataclass, field, InitVar
+from time import sleep, monotonic_ns
+from typing import Tuple, TypeVar, Type, Iterable, ClassVar, Callable
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 import random
-# import requests
+try:
+    import requests
+except ImportError:
+    # only needed to play through a game broker
+    requests = None
 
 # maximum and minimum values for our heuristic scores (usually represents an end of game condition)
 MAX_HEURISTIC_SCORE = 2000000000
 MIN_HEURISTIC_SCORE = -2000000000
+# seconds to wait for the game broker before giving up on a request
+BROKER_TIMEOUT = 5.0
+# initial half width of the aspiration window around the previous iteration's score
+ASPIRATION_WINDOW = 50
+# maximum number of attacks searched past the search depth
+QUIESCENCE_DEPTH = 4
+# seconds of max_time kept back for the nodes searched between clock reads and for playing the move
+SEARCH_TIME_MARGIN = 0.02
+# the clock is read once every CLOCK_CHECK_NODES nodes (a power of 2)
+CLOCK_CHECK_NODES = 256
 
 
 # This defines the objects used for the game
@@ -36,16 +51,136 @@ class Player(Enum):
         else:
             return Player.Attacker
 
+# unit types that can only move forward and not while engaged in combat
+MOVE_RESTRICTED_TYPES = frozenset({UnitType.AI, UnitType.Firewall, UnitType.Program})
+# (row, col) deltas of the 4 adjacent cells, and the forward ones for each player (indexed by player value)
+ADJACENT_DELTAS = ((-1,0),(0,-1),(1,0),(0,1))
+ATTACKER_DELTAS = ((-1,0),(0,-1))
+DEFENDER_DELTAS = ((1,0),(0,1))
+FORWARD_DELTAS = (ATTACKER_DELTAS, DEFENDER_DELTAS)
+# MOVE_RESTRICTED_TYPES membership indexed by unit type value, and their values
+RESTRICTED_BY_TYPE = tuple(unit_type in MOVE_RESTRICTED_TYPES for unit_type in UnitType)
+RESTRICTED_TYPE_VALUES = tuple(sorted(unit_type.value for unit_type in MOVE_RESTRICTED_TYPES))
+
 class GameType(Enum):
     AttackerVsDefender = 0
     AttackerVsComp = 1
     CompVsDefender = 2
     CompVsComp = 3
+
+class TTFlag(Enum):
+    """How a transposition table value relates to the true minimax value."""
+    Exact = 0
+    Lower = 1
+    Upper = 2
         
 ##############################################################################################################
 
-@dataclass(slots=True)
+# Zobrist keys, one per (cell, player, unit type, health) plus one for the side to move
+ZOBRIST_SIDE = random.Random(0).getrandbits(64)
+# transposition table slots, indexed by the low bits of the Zobrist key
+TT_SIZE = 1 << 18
+TT_MASK = TT_SIZE - 1
+_zobrist_tables : dict[int,list[int]] = {}
+
+def zobrist_table(dim: int) -> list[int]:
+    """Zobrist keys for a dim x dim board, indexed by ((cell*2+player)*5+type)*10+health."""
+    table = _zobrist_tables.get(dim)
+    if table is None:
+        rng = random.Random(dim)
+        table = [rng.getrandbits(64) for _ in range(dim*dim*2*5*10)]
+        _zobrist_tables[dim] = table
+    return table
+
+# Bitboards use bit row*dim+col for a cell
+_adjacent_masks : dict[int,list[int]] = {}
+
+def adjacent_masks(dim: int) -> list[int]:
+    """Bitboard of the adjacent (up, left, down, right) cells of every cell of a dim x dim board."""
+    masks = _adjacent_masks.get(dim)
+    if masks is None:
+        masks = []
+        for row in range(dim):
+            for col in range(dim):
+                mask = 0
+                for (dr, dc) in ADJACENT_DELTAS:
+                    if 0 <= row+dr < dim and 0 <= col+dc < dim:
+                        mask |= 1 << ((row+dr)*dim + col+dc)
+                masks.append(mask)
+        _adjacent_masks[dim] = masks
+    return masks
+
+_forward_masks : dict[int,Tuple[list[int],list[int]]] = {}
+
+def forward_masks(dim: int) -> Tuple[list[int],list[int]]:
+    """Bitboard of the cells a restricted unit may move to from every cell, for each player (indexed by player value)."""
+    masks = _forward_masks.get(dim)
+    if masks is None:
+        masks = ([], [])
+        for (player, deltas) in enumerate(FORWARD_DELTAS):
+            for row in range(dim):
+                for col in range(dim):
+                    mask = 0
+                    for (dr, dc) in deltas:
+                        if 0 <= row+dr < dim and 0 <= col+dc < dim:
+                            mask |= 1 << ((row+dr)*dim + col+dc)
+                    masks[player].append(mask)
+        _forward_masks[dim] = masks
+    return masks
+
+_neighbor_tables : dict[int,Tuple[list[Tuple[int,...]],list[Tuple[int,...]]]] = {}
+
+def neighbor_tables(dim: int) -> Tuple[list[Tuple[int,...]],list[Tuple[int,...]]]:
+    """In-board neighbours of every cell as flat indices (row*dim+col).
+
+    Returns the cells within 1 and within 2 of each cell (both including the cell itself).
+    """
+    tables = _neighbor_tables.get(dim)
+    if tables is None:
+        def within(row, col, dist):
+            return tuple(r*dim+c for r in range(max(row-dist,0), min(row+dist+1,dim))
+                                 for c in range(max(col-dist,0), min(col+dist+1,dim)))
+        cells = [divmod(idx, dim) for idx in range(dim*dim)]
+        range1 = [within(row, col, 1) for (row, col) in cells]
+        range2 = [within(row, col, 2) for (row, col) in cells]
+        tables = (range1, range2)
+        _neighbor_tables[dim] = tables
+    return tables
+
+_direction_shifts : dict[int,dict[Tuple[int,int],Tuple[int,int]]] = {}
+
+def direction_shifts(dim: int) -> dict[Tuple[int,int],Tuple[int,int]]:
+    """(shift, mask) of every adjacent (dr, dc) direction of a dim x dim board.
+
+    Cells whose neighbour in a direction belongs to bitboard bb are
+    (bb << -shift if shift < 0 else bb >> shift) & mask, with mask dropping row wraparounds.
+    """
+    shifts = _direction_shifts.get(dim)
+    if shifts is None:
+        full = (1 << dim*dim) - 1
+        first_col = sum(1 << row*dim for row in range(dim))
+        last_col = first_col << (dim-1)
+        col_masks = {-1: full & ~first_col, 0: full, 1: full & ~last_col}
+        shifts = {(dr, dc): (dr*dim + dc, col_masks[dc]) for (dr, dc) in ADJACENT_DELTAS}
+        _direction_shifts[dim] = shifts
+    return shifts
+
+_range_masks : dict[int,Tuple[list[int],list[int]]] = {}
+
+def range_masks(dim: int) -> Tuple[list[int],list[int]]:
+    """Bitboards of the cells within 1 and within 2 of every cell (including the cell itself)."""
+    masks = _range_masks.get(dim)
+    if masks is None:
+        (range1, range2) = neighbor_tables(dim)
+        masks = ([sum(1 << idx for idx in cells) for cells in range1], [sum(1 << idx for idx in cells) for cells in range2])
+        _range_masks[dim] = masks
+    return masks
+
+##############################################################################################################
+
+@dataclass(slots=True, frozen=True)
 class Unit:
+    """A unit on the board, immutable so that instances can be shared (see UNIT_POOL)."""
     player: Player = Player.Attacker
     type: UnitType = UnitType.Program
     health : int = 9
@@ -70,14 +205,6 @@ class Unit:
         """Are we alive ? (Checks health is bigger than 0)"""
         return self.health > 0
 
-    def mod_health(self, health_delta : int):
-        """Modify this unit's health by delta amount."""
-        self.health += health_delta
-        if self.health < 0:
-            self.health = 0
-        elif self.health > 9:
-            self.health = 9
-
     def to_string(self) -> str:
         """Text representation of this unit."""
         p = self.player.name.lower()[0]
@@ -90,21 +217,37 @@ class Unit:
     
     def damage_amount(self, target: Unit) -> int:
         """How much can this unit damage another unit."""
-        amount = self.damage_table[self.type.value][target.type.value]
+        amount = DAMAGE_TABLE[self.type.value*5 + target.type.value]
         if target.health - amount < 0:
             return target.health
         return amount
 
     def repair_amount(self, target: Unit) -> int:
         """How much can this unit repair another unit."""
-        amount = self.repair_table[self.type.value][target.type.value]
+        amount = REPAIR_TABLE[self.type.value*5 + target.type.value]
         if target.health + amount > 9:
             return 9 - target.health
         return amount
 
+# every possible unit, so that health changes pick an existing instance instead of allocating one
+UNIT_POOL = {(player, unit_type, health): Unit(player, unit_type, health) for player in Player for unit_type in UnitType for health in range(10)}
+
+def modded(unit: Unit, health_delta: int) -> Unit | None:
+    """The unit with its health modified by delta amount (clamped to 9), or None if it died."""
+    health = max(0, min(9, unit.health + health_delta))
+    if health == 0:
+        return None
+    return UNIT_POOL[(unit.player, unit.type, health)]
+
+# flat copies of the unit tables, indexed by source type * 5 + target type
+DAMAGE_TABLE = tuple(amount for row in Unit.damage_table for amount in row)
+REPAIR_TABLE = tuple(amount for row in Unit.repair_table for amount in row)
+# (repairing type, repaired type) values of the repairs that restore health
+REPAIR_PAIRS = tuple((src, dst) for src in range(5) for dst in range(5) if REPAIR_TABLE[src*5 + dst] > 0)
+
 ##############################################################################################################
 
-@dataclass(slots=True)
+@dataclass(slots=True, frozen=True)
 class Coord:
     """Representation of a game cell coordinate (row, col)."""
     row : int = 0
@@ -133,21 +276,16 @@ class Coord:
         return self.to_string()
     
     def clone(self) -> Coord:
-        """Clone a Coord."""
-        return copy.copy(self)
+        """Clone a Coord (Coords are immutable, so it is shared)."""
+        return self
 
     def iter_range(self, dist: int) -> Iterable[Coord]:
         """Iterates over Coords inside a rectangle centered on our Coord."""
-        for row in range(self.row-dist,self.row+1+dist):
-            for col in range(self.col-dist,self.col+1+dist):
-                yield Coord(row,col)
+        return [Coord(row,col) for row in range(self.row-dist,self.row+1+dist) for col in range(self.col-dist,self.col+1+dist)]
 
     def iter_adjacent(self) -> Iterable[Coord]:
         """Iterates over adjacent Coords."""
-        yield Coord(self.row-1,self.col)
-        yield Coord(self.row,self.col-1)
-        yield Coord(self.row+1,self.col)
-        yield Coord(self.row,self.col+1)
+        return (Coord(self.row-1,self.col), Coord(self.row,self.col-1), Coord(self.row+1,self.col), Coord(self.row,self.col+1))
 
     @classmethod
     def from_string(cls, s : str) -> Coord | None:
@@ -156,16 +294,15 @@ class Coord:
         for sep in " ,.:;-_":
                 s = s.replace(sep, "")
         if (len(s) == 2):
-            coord = Coord()
-            coord.row = "ABCDEFGHIJKLMNOPQRSTUVWXYZ".find(s[0:1].upper())
-            coord.col = "0123456789abcdef".find(s[1:2].lower())
-            return coord
+            return Coord(
+                row="ABCDEFGHIJKLMNOPQRSTUVWXYZ".find(s[0:1].upper()),
+                col="0123456789abcdef".find(s[1:2].lower()))
         else:
             return None
 
 ##############################################################################################################
 
-@dataclass(slots=True)
+@dataclass(slots=True, frozen=True)
 class CoordPair:
     """Representation of a game move or a rectangular area via 2 Coords."""
     src : Coord = field(default_factory=Coord)
@@ -180,14 +317,12 @@ class CoordPair:
         return self.to_string()
 
     def clone(self) -> CoordPair:
-        """Clones a CoordPair."""
-        return copy.copy(self)
+        """Clones a CoordPair (CoordPairs are immutable, so it is shared)."""
+        return self
 
     def iter_rectangle(self) -> Iterable[Coord]:
         """Iterates over cells of a rectangular area."""
-        for row in range(self.src.row,self.dst.row+1):
-            for col in range(self.src.col,self.dst.col+1):
-                yield Coord(row,col)
+        return [Coord(row,col) for row in range(self.src.row,self.dst.row+1) for col in range(self.src.col,self.dst.col+1)]
 
     @classmethod
     def from_quad(cls, row0: int, col0: int, row1: int, col1: int) -> CoordPair:
@@ -206,17 +341,41 @@ class CoordPair:
         for sep in " ,.:;-_":
                 s = s.replace(sep, "")
         if (len(s) == 4):
-            coords = CoordPair()
-            coords.src.row = "ABCDEFGHIJKLMNOPQRSTUVWXYZ".find(s[0:1].upper())
-            coords.src.col = "0123456789abcdef".find(s[1:2].lower())
-            coords.dst.row = "ABCDEFGHIJKLMNOPQRSTUVWXYZ".find(s[2:3].upper())
-            coords.dst.col = "0123456789abcdef".find(s[3:4].lower())
-            return coords
+            return CoordPair(
+                src=Coord.from_string(s[0:2]),
+                dst=Coord.from_string(s[2:4]))
         else:
             return None
 
 ##############################################################################################################
 
+# Coords and CoordPairs are immutable, the ones of a board are built once and shared
+_coord_tables : dict[int,list[Coord]] = {}
+_move_tables : dict[int,list[CoordPair]] = {}
+
+def coord_table(dim: int) -> list[Coord]:
+    """The Coord of every cell of a dim x dim board, indexed by row*dim+col."""
+    coords = _coord_tables.get(dim)
+    if coords is None:
+        coords = [Coord(row, col) for row in range(dim) for col in range(dim)]
+        _coord_tables[dim] = coords
+    return coords
+
+def move_table(dim: int) -> list[CoordPair]:
+    """The CoordPair of every move code of a dim x dim board.
+
+    A move code is src*cells + dst using flat cell indices (row*dim+col). The search works on
+    move codes, they also index the history table.
+    """
+    moves = _move_tables.get(dim)
+    if moves is None:
+        coords = coord_table(dim)
+        moves = [CoordPair(src, dst) for src in coords for dst in coords]
+        _move_tables[dim] = moves
+    return moves
+
+##############################################################################################################
+
 @dataclass(slots=True)
 class Options:
     """Representation of the game options. (I think this is optional not sure)"""
@@ -229,21 +388,53 @@ class Options:
     max_turns : int | None = 100
     randomize_moves : bool = True
     broker : str | None = None
+    # processes searching the root moves in parallel, 1 searches in this process only
+    workers : int = 1
 
 ##############################################################################################################
 
 @dataclass(slots=True)
 class Stats:
     """Representation of the global game statistics."""
-    evaluations_per_depth : dict[int,int] = field(default_factory=dict)
+    # indexed by depth from the root (ply), over every iteration of every search, see reserve_depth
+    evaluations_per_depth : list[int] = field(default_factory=list)
+    # negamax nodes whose moves were searched, for the branching factor
+    parents : int = 0
     total_seconds: float = 0.0
-    minimax_entry: int = 0
+    # nodes searched over the whole game
+    nodes : int = 0
 
-    def increment_evaluations(self, depth):
-        if depth in self.evaluations_per_depth:
-            self.evaluations_per_depth[depth] += 1
-        else:
-            self.evaluations_per_depth[depth] = 1
+    def reserve_depth(self, max_depth: int):
+        """Make room for the evaluation counts of plies up to max_depth."""
+        missing = max_depth + 1 - len(self.evaluations_per_depth)
+        if missing > 0:
+            self.evaluations_per_depth.extend([0] * missing)
+
+##############################################################################################################
+
+@dataclass(slots=True)
+class TTEntry:
+    """Transposition table entry for a searched position."""
+    key : int  # full Zobrist key, slots are shared by keys with the same low bits
+    depth : int
+    flag : TTFlag
+    value : int
+    best_move : int | None  # move code, see move_table
+
+##############################################################################################################
+
+@dataclass(slots=True)
+class MoveUndo:
+    """Snapshot of the cells (as flat row*dim+col indices) and flags changed by a move, used to undo it."""
+    src : int
+    dst : int
+    src_unit_prev : Unit | None
+    dst_unit_prev : Unit | None
+    adj_prev : list[Tuple[int,Unit | None]]
+    game_over_prev : bool
+    next_player_prev : Player
+    turns_played_prev : int
+    zkey_prev : int
 
 ##############################################################################################################
 
@@ -251,39 +442,124 @@ class Stats:
 class Game:
     """Representation of the game state."""
     board: list[list[Unit | None]] = field(default_factory=list)
+    # flat row-major mirrors of the board as plain ints (-1 type/player for an empty cell)
+    type_grid: list[int] = field(default_factory=list)
+    player_grid: list[int] = field(default_factory=list)
+    health_grid: list[int] = field(default_factory=list)
     next_player: Player = Player.Attacker
     turns_played : int = 0
     options: Options = field(default_factory=Options)
     stats: Stats = field(default_factory=Stats)
-    _attacker_has_ai : bool = True
-    _defender_has_ai : bool = True
+    # cached is_finished() result, updated when an AI dies or the turn limit is reached
+    _game_over : bool = False
+    zkey : int = 0
+    _zobrist : list[int] = field(default_factory=list)
+    # occupancy bitboard of each player
+    occ_attacker : int = 0
+    occ_defender : int = 0
+    # bitboard of the units of each type (both players, indexed by unit type value) and of the damaged units
+    by_type : list[int] = field(default_factory=list)
+    damaged : int = 0
+    _adj_mask : list[int] = field(default_factory=list)
+    # flat indices of the cells within 1 of every cell, the cells hit by a self-destruct
+    _range1 : list[Tuple[int,...]] = field(default_factory=list)
+    # transposition table, allocated by prepare_search
+    _tt : list[TTEntry | None] = field(default_factory=list)
+    # leaf evaluation of the current search, see heuristic_e2_for
+    _evaluate : Callable[[Game], int] | None = None
+    # move ordering: the last 2 quiet moves that caused a cutoff at each ply, and a score per move code
+    killers : list[list[int | None]] = field(default_factory=list)
+    history : list[int] = field(default_factory=list)
+    # move generation buffer reused by every node of a search
+    _moves_buffer : list[int] = field(default_factory=list)
+    # (score, move code) of the best root move searched so far, kept for a depth cut short by the deadline
+    _root_best : Tuple[int, int] | None = None
+    # game broker connection kept alive across requests, and the move being posted in the background
+    _broker_session : requests.Session | None = None
+    _broker_pool : ThreadPoolExecutor | None = None
+    _broker_post : Future | None = None
+    # processes for the parallel root search, created on first use
+    _workers : ProcessPoolExecutor | None = None
+    # False leaves the board empty (see from_snapshot)
+    default_units : InitVar[bool] = True
     score_list = []
 
-    def __post_init__(self):
+    def __post_init__(self, default_units: bool):
         """Automatically called after class init to set up the default board state."""
         dim = self.options.dim
         self.board = [[None for _ in range(dim)] for _ in range(dim)]
+        self.type_grid = [-1] * (dim*dim)
+        self.player_grid = [-1] * (dim*dim)
+        self.health_grid = [0] * (dim*dim)
+        self._zobrist = zobrist_table(dim)
+        self.zkey = 0
+        self.occ_attacker = 0
+        self.occ_defender = 0
+        self.by_type = [0] * 5
+        self.damaged = 0
+        self._adj_mask = adjacent_masks(dim)
+        self._range1 = neighbor_tables(dim)[0]
+        if not default_units:
+            return
         md = dim-1
-        self.set(Coord(0,0),Unit(player=Player.Defender,type=UnitType.AI))
-        self.set(Coord(1,0),Unit(player=Player.Defender,type=UnitType.Tech))
-        self.set(Coord(0,1),Unit(player=Player.Defender,type=UnitType.Tech))
-        self.set(Coord(2,0),Unit(player=Player.Defender,type=UnitType.Firewall))
-        self.set(Coord(0,2),Unit(player=Player.Defender,type=UnitType.Firewall))
-        self.set(Coord(1,1),Unit(player=Player.Defender,type=UnitType.Program))
-        self.set(Coord(md,md),Unit(player=Player.Attacker,type=UnitType.AI))
-        self.set(Coord(md-1,md),Unit(player=Player.Attacker,type=UnitType.Virus))
-        self.set(Coord(md,md-1),Unit(player=Player.Attacker,type=UnitType.Virus))
-        self.set(Coord(md-2,md),Unit(player=Player.Attacker,type=UnitType.Program))
-        self.set(Coord(md,md-2),Unit(player=Player.Attacker,type=UnitType.Program))
-        self.set(Coord(md-1,md-1),Unit(player=Player.Attacker,type=UnitType.Firewall))
+        # full health units shared with the rest of the game, see UNIT_POOL
+        self.set(Coord(0,0),UNIT_POOL[(Player.Defender, UnitType.AI, 9)])
+        self.set(Coord(1,0),UNIT_POOL[(Player.Defender, UnitType.Tech, 9)])
+        self.set(Coord(0,1),UNIT_POOL[(Player.Defender, UnitType.Tech, 9)])
+        self.set(Coord(2,0),UNIT_POOL[(Player.Defender, UnitType.Firewall, 9)])
+        self.set(Coord(0,2),UNIT_POOL[(Player.Defender, UnitType.Firewall, 9)])
+        self.set(Coord(1,1),UNIT_POOL[(Player.Defender, UnitType.Program, 9)])
+        self.set(Coord(md,md),UNIT_POOL[(Player.Attacker, UnitType.AI, 9)])
+        self.set(Coord(md-1,md),UNIT_POOL[(Player.Attacker, UnitType.Virus, 9)])
+        self.set(Coord(md,md-1),UNIT_POOL[(Player.Attacker, UnitType.Virus, 9)])
+        self.set(Coord(md-2,md),UNIT_POOL[(Player.Attacker, UnitType.Program, 9)])
+        self.set(Coord(md,md-2),UNIT_POOL[(Player.Attacker, UnitType.Program, 9)])
+        self.set(Coord(md-1,md-1),UNIT_POOL[(Player.Attacker, UnitType.Firewall, 9)])
+        self._game_over = self.has_winner() is not None
+
+    def snapshot(self) -> Tuple[Options, int, int, list[Tuple[int,int,int,int]]]:
+        """Picklable copy of the game position: options, next player, turns played and (cell, player, type, health) of each unit."""
+        units = [(idx, self.player_grid[idx], t, self.health_grid[idx]) for (idx, t) in enumerate(self.type_grid) if t >= 0]
+        return (self.options, self.next_player.value, self.turns_played, units)
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Tuple[Options, int, int, list[Tuple[int,int,int,int]]]) -> Game:
+        """Create a game at the position of a snapshot."""
+        (options, next_player, turns_played, units) = snapshot
+        game = cls(options=options, default_units=False)
+        for (idx, player, t, health) in units:
+            game.set_idx(idx, UNIT_POOL[(Player(player), UnitType(t), health)])
+        game.next_player = Player(next_player)
+        game.turns_played = turns_played
+        # the side to move is flipped in the key on every turn
+        if turns_played % 2:
+            game.zkey ^= ZOBRIST_SIDE
+        game._game_over = game.has_winner() is not None
+        return game
 
     def clone(self) -> Game:
-        """Make a new copy of a game for minimax recursion.
+        """Make a new copy of a game that can be played or searched without changing this one.
 
-        Shallow copy of everything except the board (options and stats are shared).
+        Shallow copy of the position except the board (options and stats are shared).
+        Units are immutable, so copying the rows is a full copy of the board.
+        The copy gets its own search tables (set up by prepare_search), broker connection and workers.
         """
         new = copy.copy(self)
-        new.board = copy.deepcopy(self.board)
+        new.board = [row[:] for row in self.board]
+        new.type_grid = self.type_grid[:]
+        new.player_grid = self.player_grid[:]
+        new.health_grid = self.health_grid[:]
+        new.by_type = self.by_type[:]
+        new._tt = []
+        new._evaluate = None
+        new.killers = []
+        new.history = []
+        new._moves_buffer = []
+        new._root_best = None
+        new._broker_session = None
+        new._broker_pool = None
+        new._broker_post = None
+        new._workers = None
         return new
 
     def is_empty(self, coord : Coord) -> bool:
@@ -293,12 +569,13 @@ class Game:
     #own added function
     def in_combat(self, coord : Coord) -> bool:
         """Check if a unit is in combat (must be valid coord)."""
-        unitSrc = self.get(coord)
-        for adjacent_coord in coord.iter_adjacent():
-            unitDst = self.get(adjacent_coord)
-            if self.is_valid_coord(adjacent_coord) and not self.is_empty(adjacent_coord) and unitSrc.player != unitDst.player:
-                return True
-        return False
+        unitSrc = self.board[coord.row][coord.col]
+        enemy = self.occ_defender if unitSrc.player is Player.Attacker else self.occ_attacker
+        return (enemy & self._adj_mask[coord.row * self.options.dim + coord.col]) != 0
+
+    def occupancy(self, player: Player) -> int:
+        """Occupancy bitboard of a player's units."""
+        return self.occ_attacker if player is Player.Attacker else self.occ_defender
 
     def get(self, coord : Coord) -> Unit | None:
         """Get contents of a board cell of the game at Coord."""
@@ -310,94 +587,149 @@ class Game:
     def set(self, coord : Coord, unit : Unit | None):
         """Set contents of a board cell of the game at Coord."""
         if self.is_valid_coord(coord):
-            self.board[coord.row][coord.col] = unit
-
-    def remove_dead(self, coord: Coord):
-        """Remove unit at Coord if dead."""
-        unit = self.get(coord)
-        if unit is not None and not unit.is_alive():
-            self.set(coord,None)
-            if unit.type == UnitType.AI:
-                if unit.player == Player.Attacker:
-                    self._attacker_has_ai = False
-                else:
-                    self._defender_has_ai = False 
+            self.set_idx(coord.row * self.options.dim + coord.col, unit)
+
+    def set_idx(self, idx : int, unit : Unit | None):
+        """Set contents of a board cell given by its flat index (row*dim+col), keeping grids, bitboards and key in sync."""
+        (row, col) = divmod(idx, self.options.dim)
+        old = self.board[row][col]
+        bit = 1 << idx
+        if old is not None:
+            self.zkey ^= self._zobrist[((idx*2 + old.player.value)*5 + old.type.value)*10 + old.health]
+            if old.player is Player.Attacker:
+                self.occ_attacker ^= bit
+            else:
+                self.occ_defender ^= bit
+            self.by_type[old.type.value] ^= bit
+        if unit is not None:
+            self.zkey ^= self._zobrist[((idx*2 + unit.player.value)*5 + unit.type.value)*10 + unit.health]
+            if unit.player is Player.Attacker:
+                self.occ_attacker ^= bit
+            else:
+                self.occ_defender ^= bit
+            self.by_type[unit.type.value] ^= bit
+            if unit.health < 9:
+                self.damaged |= bit
+            else:
+                self.damaged &= ~bit
+            self.type_grid[idx] = unit.type.value
+            self.player_grid[idx] = unit.player.value
+            self.health_grid[idx] = unit.health
+        else:
+            self.damaged &= ~bit
+            self.type_grid[idx] = -1
+            self.player_grid[idx] = -1
+            self.health_grid[idx] = 0
+        self.board[row][col] = unit
 
     def mod_health(self, coord : Coord, health_delta : int):
-        """Modify health of unit at Coord (positive or negative delta)."""
-        target = self.get(coord)
+        """Modify health of unit at Coord (positive or negative delta, must be valid coord), removing it if dead."""
+        self.mod_health_idx(coord.row * self.options.dim + coord.col, health_delta)
+
+    def mod_health_idx(self, idx : int, health_delta : int):
+        """Modify health of unit at a flat cell index, removing it if dead."""
+        target = self.board[idx // self.options.dim][idx % self.options.dim]
         if target is not None:
-            target.mod_health(health_delta)
-            self.remove_dead(coord)
+            unit = modded(target, health_delta)
+            self.set_idx(idx, unit)
+            if unit is None and target.type is UnitType.AI:
+                self._game_over = True
 
     #Valid movements implemented
     def is_valid_move(self, coords : CoordPair) -> bool:
-        """Validate a move expressed as a CoordPair. TODO """
+        """Validate a move expressed as a CoordPair."""
         if not self.is_valid_coord(coords.src) or not self.is_valid_coord(coords.dst):
             return False
         unitSrc = self.get(coords.src)
-        if unitSrc is None or unitSrc.player != self.next_player:
+        if unitSrc is None or unitSrc.player is not self.next_player:
             return False
         # Necessary implementation for explosion
         if coords.dst == coords.src:
             return True
-        # Make sure that targets are within an unit distance
-        if abs(coords.src.col - coords.dst.col) > 1:
+        # Make sure that targets are adjacent (no diagonals)
+        dr = coords.dst.row - coords.src.row
+        dc = coords.dst.col - coords.src.col
+        if (dr, dc) not in ADJACENT_DELTAS:
             return False
-        # Check for combat or repair, repair move is only valid if target health < 9
+        # Check for combat or repair, repair move is only valid if it restores some health
         unitDst = self.get(coords.dst)
-        if unitDst is not None and unitDst.health < 9 and unitDst.player.name == unitSrc.player.name and unitSrc.repair_amount(unitDst) > 0:
+        if unitDst is not None:
+            if unitDst.player is unitSrc.player:
+                return unitSrc.repair_amount(unitDst) > 0
             return True
-        elif unitDst is not None and unitDst.player.name != unitSrc.player.name:
-            return True
-        elif unitDst is not None and unitDst.player.name == unitSrc.player.name and unitDst.health == 9:
-            return False
-        elif unitDst is not None and unitDst.player.name == unitSrc.player.name and (unitSrc.repair_amount(unitDst) == 0 or unitDst.health < 9):
-            return False
-            
         # to check that AI, Firewall, and Program can only move up, left | or down, right (defender) 
-        if unitSrc.type.name != "Tech" and unitSrc.type.name != "Virus":
-            if unitSrc.player.name == "Attacker" and ((coords.dst.col != coords.src.col - 1) and (coords.dst.row != coords.src.row - 1)):
-                return False
-            elif unitSrc.player.name == "Defender" and ((coords.dst.col != coords.src.col + 1) and (coords.dst.row != coords.src.row + 1)):
+        if unitSrc.type in MOVE_RESTRICTED_TYPES:
+            if (dr, dc) not in FORWARD_DELTAS[unitSrc.player.value]:
                 return False
             # Check if AI, Firewall and Program are engaged in combat
-            elif self.in_combat(coords.src):
-                    return False
+            if self.in_combat(coords.src):
+                return False
         return True
 
     def perform_move(self, coords : CoordPair) -> Tuple[bool,str]:
-        """Validate and perform a move expressed as a CoordPair. TODO: WRITE MISSING CODE!!!"""
-        unitSrc = self.get(coords.src)
-        unitDst = self.get(coords.dst)
+        """Validate and perform a move expressed as a CoordPair."""
         if self.is_valid_move(coords):
-            # Explosion move performance
-            if coords.dst == coords.src:
-                for adjacent_coord in coords.src.iter_range(1):
-                    self.mod_health(adjacent_coord, -2)
-                self.mod_health(coords.src, -unitSrc.health)
-            # End of explosion code
-            # Bi-directional damage time
-            elif unitDst is not None and unitSrc.player != unitDst.player:
-                dmg = unitSrc.damage_amount(unitDst)
-                sdmg = unitDst.damage_amount(unitSrc)
-                self.mod_health(coords.dst, -dmg)
-                self.mod_health(coords.src, -sdmg)
-            # Repair amount, support moment
-            elif unitDst is not None and unitSrc.player == unitDst.player:
-                rpr = unitSrc.repair_amount(unitDst)
-                self.mod_health(coords.dst, rpr)
-            # Moving and setting units around
-            else:
-                self.set(coords.dst,self.get(coords.src))
-                self.set(coords.src,None)
+            dim = self.options.dim
+            self.perform_move_idx(coords.src.row*dim + coords.src.col, coords.dst.row*dim + coords.dst.col)
             return (True,"Move executed: " + str(coords))
         return (False,"invalid move")
 
+    def explode_idx(self, idx : int):
+        """Self-destruct the unit at a flat cell index, damaging every unit around it by 2."""
+        for adjacent_idx in self._range1[idx]:
+            self.mod_health_idx(adjacent_idx, -2)
+        # the unit itself is destroyed whatever health it has left
+        self.mod_health_idx(idx, -9)
+
+    def perform_move_idx(self, src : int, dst : int) -> MoveUndo:
+        """Perform an already validated move between flat cell indices and return what is needed to undo it."""
+        dim = self.options.dim
+        board = self.board
+        unitSrc = board[src // dim][src % dim]
+        unitDst = board[dst // dim][dst % dim]
+        undo = MoveUndo(
+            src, dst,
+            unitSrc, unitDst, [],
+            self._game_over,
+            self.next_player, self.turns_played, self.zkey)
+        # Explosion: remember every cell in range before damaging them
+        if src == dst:
+            for idx in self._range1[src]:
+                undo.adj_prev.append((idx, board[idx // dim][idx % dim]))
+            self.explode_idx(src)
+        # Moving and setting units around
+        elif unitDst is None:
+            self.set_idx(dst, unitSrc)
+            self.set_idx(src, None)
+        # Bi-directional damage time
+        elif unitSrc.player is not unitDst.player:
+            dmg = unitSrc.damage_amount(unitDst)
+            sdmg = unitDst.damage_amount(unitSrc)
+            self.mod_health_idx(dst, -dmg)
+            self.mod_health_idx(src, -sdmg)
+        # Repair amount, support moment
+        else:
+            self.mod_health_idx(dst, unitSrc.repair_amount(unitDst))
+        return undo
+
+    def undo_move(self, undo : MoveUndo):
+        """Restore the game to its state before the move recorded in undo."""
+        for (idx, unit) in undo.adj_prev:
+            self.set_idx(idx, unit)
+        self.set_idx(undo.dst, undo.dst_unit_prev)
+        self.set_idx(undo.src, undo.src_unit_prev)
+        self._game_over = undo.game_over_prev
+        self.next_player = undo.next_player_prev
+        self.turns_played = undo.turns_played_prev
+        self.zkey = undo.zkey_prev
+
     def next_turn(self):
         """Transitions game to the next turn."""
         self.next_player = self.next_player.next()
         self.turns_played += 1
+        self.zkey ^= ZOBRIST_SIDE
+        if self.options.max_turns is not None and self.turns_played >= self.options.max_turns:
+            self._game_over = True
 
     def to_string(self) -> str:
         """Pretty text representation of the game."""
@@ -405,20 +737,17 @@ class Game:
         output = ""
         output += f"Next player: {self.next_player.name}\n"
         output += f"Turns played: {self.turns_played}\n"
-        coord = Coord()
+        coords = coord_table(dim)
         output += "\n   "
         for col in range(dim):
-            coord.col = col
-            label = coord.col_string()
+            label = coords[col].col_string()
             output += f"{label:^3} "
         output += "\n"
         for row in range(dim):
-            coord.row = row
-            label = coord.row_string()
+            label = coords[row*dim].row_string()
             output += f"{label}: "
             for col in range(dim):
-                coord.col = col
-                unit = self.get(coord)
+                unit = self.get(coords[row*dim + col])
                 if unit is None:
                     output += " .  "
                 else:
@@ -458,7 +787,6 @@ class Game:
                     print(f"Broker {self.next_player.name}: ",end='')
                     print(result)
                     file.write(result)
-                    file.flush()
                     if success:
                         self.next_turn()
                         break
@@ -470,9 +798,7 @@ class Game:
                 if success:
                     print(f"Player {self.next_player.name}: ",end='')
                     print(result)
-                    file.write(f"Player {self.next_player.name}: ")
-                    file.write(result) 
-                    file.flush()
+                    file.write(f"Player {self.next_player.name}: {result}")
                     self.next_turn()
                     break
                 else:
@@ -487,27 +813,30 @@ class Game:
                 print(f"Computer {self.next_player.name}: ",end='')
                 print(result)
                 file.write(result)
-                file.flush()
                 self.next_turn()
         return mv
 
     def player_units(self, player: Player) -> Iterable[Tuple[Coord,Unit]]:
         """Iterates over all units belonging to a player."""
-        for coord in CoordPair.from_dim(self.options.dim).iter_rectangle():
-            unit = self.get(coord)
-            if unit is not None and unit.player == player:
-                yield (coord,unit)
+        dim = self.options.dim
+        p = player.value
+        player_grid = self.player_grid
+        board = self.board
+        coords = coord_table(dim)
+        return [(coords[idx],board[idx // dim][idx % dim]) for idx in range(dim*dim) if player_grid[idx] == p]
 
     def is_finished(self) -> bool:
         """Check if the game is over."""
-        return self.has_winner() is not None
+        return self._game_over
 
     def has_winner(self) -> Player | None:
         """Check if the game is over and returns winner"""
         if self.options.max_turns is not None and self.turns_played >= self.options.max_turns:
             return Player.Defender
-        if self._attacker_has_ai:
-            if self._defender_has_ai:
+        # the AIs are found on the bitboards, no need to look at the board
+        ais = self.by_type[UnitType.AI.value]
+        if ais & self.occ_attacker:
+            if ais & self.occ_defender:
                 return None
             else:
                 return Player.Attacker    
@@ -515,27 +844,132 @@ class Game:
 
     def move_candidates(self) -> Iterable[CoordPair]:
         """Generate valid move candidates for the next player."""
-        move = CoordPair()
-        for (src,_) in self.player_units(self.next_player):
-            move.src = src
-            for dst in src.iter_adjacent():
-                move.dst = dst
-                if self.is_valid_move(move):
-                    yield move.clone()
-            move.dst = src
-            yield move.clone()
-
-    def move_candidates2(self, player: Player) -> Iterable[CoordPair]:
-        """Generate valid move candidates for the next player."""
-        move = CoordPair()
-        for (src,_) in self.player_units(player):
-            move.src = src
-            for dst in src.iter_adjacent():
-                move.dst = dst
-                if self.is_valid_move(move):
-                    yield move.clone()
-            move.dst = src
-            yield move.clone()
+        moves = move_table(self.options.dim)
+        return [moves[code] for code in self.move_candidates_codes()]
+
+    def move_candidates_codes(self, codes: list[int] | None = None) -> list[int]:
+        """Valid moves for the next player as move codes (see move_table).
+
+        Same rules as is_valid_move, checked with bitboards for all targets of a unit at once.
+        The moves replace the contents of codes when given, so that a list can be reused.
+        """
+        dim = self.options.dim
+        cells = dim*dim
+        player = self.next_player
+        own = self.occupancy(player)
+        enemy = self.occupancy(player.next())
+        empty = ~(own | enemy)
+        adjacent = self._adj_mask
+        forward = forward_masks(dim)[player.value]
+        type_grid = self.type_grid
+        health_grid = self.health_grid
+        if codes is None:
+            codes = []
+        else:
+            codes.clear()
+        # walk the set bits of our occupancy bitboard, lowest cell first
+        bb = own
+        while bb:
+            lsb = bb & -bb
+            bb ^= lsb
+            src = lsb.bit_length() - 1
+            t = type_grid[src]
+            near = adjacent[src]
+            # attacks are always valid
+            targets = near & enemy
+            # AI, Firewall and Program can only move forward, and not while engaged in combat
+            if not RESTRICTED_BY_TYPE[t]:
+                targets |= near & empty
+            elif not targets:
+                targets |= near & empty & forward[src]
+            # repairs are only valid if they restore some health
+            friends = near & own
+            while friends:
+                friend = friends & -friends
+                friends ^= friend
+                dst = friend.bit_length() - 1
+                if health_grid[dst] < 9 and REPAIR_TABLE[t*5 + type_grid[dst]] > 0:
+                    targets |= friend
+            base = src * cells
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                codes.append(base + target.bit_length() - 1)
+            # self-destruct
+            codes.append(base + src)
+        return codes
+
+    def move_from_code(self, code: int) -> CoordPair:
+        """The CoordPair of a move code."""
+        return move_table(self.options.dim)[code]
+
+    def ordered_move_candidates(self, ply: int, tt_move: int | None = None) -> list[int]:
+        """Valid move codes for the next player, most promising first.
+
+        The transposition table move comes first, then attacks (most damage dealt for the least
+        taken first), then this ply's killer moves, then the remaining moves by decreasing history score.
+        """
+        cells = self.options.dim ** 2
+        enemy = self.occupancy(self.next_player.next())
+        first = []
+        captures = []
+        quiet = []
+        # the generated moves are sorted into new lists right away, so the buffer is free again
+        # before the search goes deeper
+        for move in self.move_candidates_codes(self._moves_buffer):
+            if move == tt_move:
+                first.append(move)
+            elif (enemy >> (move % cells)) & 1:
+                captures.append(move)
+            else:
+                quiet.append(move)
+        captures = self.order_attacks(captures)
+        killers = [killer for killer in self.killers[ply] if killer is not None and killer in quiet]
+        for killer in killers:
+            quiet.remove(killer)
+        quiet.sort(key=self.history.__getitem__, reverse=True)
+        return first + captures + killers + quiet
+
+    def attack_codes(self, codes: list[int] | None = None) -> list[int]:
+        """Valid attacks of the next player as move codes, in the order move_candidates_codes has them.
+
+        The attacks replace the contents of codes when given, so that a list can be reused.
+        """
+        cells = self.options.dim ** 2
+        enemy = self.occupancy(self.next_player.next())
+        adjacent = self._adj_mask
+        if codes is None:
+            codes = []
+        else:
+            codes.clear()
+        bb = self.occupancy(self.next_player)
+        while bb:
+            lsb = bb & -bb
+            bb ^= lsb
+            src = lsb.bit_length() - 1
+            targets = adjacent[src] & enemy
+            base = src * cells
+            while targets:
+                target = targets & -targets
+                targets ^= target
+                codes.append(base + target.bit_length() - 1)
+        return codes
+
+    def order_attacks(self, attacks: list[int]) -> list[int]:
+        """Attack move codes sorted by an MVV-LVA like score, most damage dealt for the least taken first."""
+        cells = self.options.dim ** 2
+        type_grid = self.type_grid
+        health_grid = self.health_grid
+        scored = []
+        for move in attacks:
+            # both units damage each other, capped by their health
+            (src, dst) = divmod(move, cells)
+            (attacker, victim) = (type_grid[src], type_grid[dst])
+            dealt = min(DAMAGE_TABLE[attacker*5 + victim], health_grid[dst])
+            taken = min(DAMAGE_TABLE[victim*5 + attacker], health_grid[src])
+            scored.append((10*dealt - taken, move))
+        scored.sort(key=lambda attack: attack[0], reverse=True)
+        return [move for (_, move) in scored]
 
     def random_move(self) -> Tuple[int, CoordPair | None, float]:
         """Returns a random move."""
@@ -546,274 +980,379 @@ class Game:
         else:
             return (0, None, 0)
         
-    def minimax(self, depth, alpha, beta, max_player: bool, time, game: Game):
-        """"Implementing minimax with alpha beta pruning algorithm"""
+    def negamax(self, depth, alpha, beta, color: int, deadline: int, ply: int = 0) -> Tuple[int, int | None]:
+        """Negamax search with alpha beta pruning and principal variation search.
+
+        Returns the score and the code of the best move (see move_table). Scores are from the point
+        of view of the player to move, color is 1 when that is the player we are searching for and
+        -1 for its opponent. ply is the distance from the root.
+        Raises TimeoutError once the monotonic_ns() deadline has passed.
+        """
         
-        #Increment into the stats array for each array depth
-        self.stats.increment_evaluations(depth)
+        #Increment into the stats array for the depth from the root
+        stats = self.stats
+        stats.evaluations_per_depth[ply] += 1
+
+        #Check for time limit not passed (only every CLOCK_CHECK_NODES nodes, reading the clock isn't free)
+        stats.nodes += 1
+        if stats.nodes & (CLOCK_CHECK_NODES - 1) == 0 and monotonic_ns() > deadline:
+            raise TimeoutError
 
         #check for end state, leaf node 
-        if self.is_finished() or depth == 0:
+        if self.is_finished():
             # returns board score, and best move
-            return self.heuristic_e2(game), None
-
-        # Incremets turn but not for the first turn
-        if self.stats.minimax_entry != 0:
-            self.next_turn()
-        self.stats.minimax_entry = 1
-
-        if max_player:
-            #Start off with -inf for max player
-            score = MIN_HEURISTIC_SCORE
-            best_move = None
-            #Initial copy of the game to return to 
-            game2 = self.clone()
-            for move in game2.move_candidates():
-                #perform move 
-                self.perform_move(move)
-                #recursive call, creates branches and nodes until leaf nodes and returns
-                (current_score, _) = self.minimax(depth - 1, alpha, beta, False, time, game)
-                #Revert the game stat back to its origin
-                self = game2.clone()
-                #Checks for best move (since the move_candidates function orders the moves it will always return  
-                # the FIRST best move)
-                if current_score > score:
-                    score = current_score
-                    best_move = move
-                #Keep a copy of the game to bring back to the origin within the loop (first call outside of loop)
-                game2 = self.clone()
-                #Check for time limit not passed
-                tot = (datetime.now() - time).total_seconds()
-                if (datetime.now() - time).total_seconds() > self.options.max_time:
+            return color * self._evaluate(self), None
+        if depth == 0:
+            # pending attacks are played out before trusting the heuristic
+            return self.quiesce(alpha, beta, color, deadline, QUIESCENCE_DEPTH), None
+
+        #Probe the transposition table, a deep enough entry can answer or narrow the search
+        tt_move = None
+        entry = self._tt[self.zkey & TT_MASK]
+        if entry is not None and entry.key == self.zkey:
+            tt_move = entry.best_move
+            if entry.depth >= depth:
+                if entry.flag is TTFlag.Exact:
+                    return entry.value, entry.best_move
+                elif entry.flag is TTFlag.Lower:
+                    alpha = max(alpha, entry.value)
+                else:
+                    beta = min(beta, entry.value)
+                if alpha >= beta:
+                    return entry.value, entry.best_move
+        alpha_orig = alpha
+        stats.parents += 1
+
+        #Moves are generated up front since the board is modified in place below,
+        # the best move stored for this position (from a shallower iteration) is tried first
+        moves = self.ordered_move_candidates(ply, tt_move)
+        enemy = self.occupancy(self.next_player.next())
+        cells = self.options.dim ** 2
+
+        #Bound methods and options used by every child are looked up once
+        alpha_beta = self.options.alpha_beta
+        perform_move = self.perform_move_idx
+        next_turn = self.next_turn
+        undo_move = self.undo_move
+        negamax = self.negamax
+        child_depth = depth - 1
+        child_ply = ply + 1
+        #Start off with -inf
+        score = MIN_HEURISTIC_SCORE
+        best_move = None
+        for (i, move) in enumerate(moves):
+            #perform move and hand the turn to the other player
+            undo = perform_move(move // cells, move % cells)
+            next_turn()
+            try:
+                if i == 0 or not alpha_beta:
+                    #first move (the expected best one) gets the full window
+                    current_score = -negamax(child_depth, -beta, -alpha, -color, deadline, child_ply)[0]
+                else:
+                    #other moves only check with a null window that they don't beat the best so far,
+                    # and are searched again with the full window if they do
+                    current_score = -negamax(child_depth, -alpha - 1, -alpha, -color, deadline, child_ply)[0]
+                    if alpha < current_score < beta:
+                        current_score = -negamax(child_depth, -beta, -current_score, -color, deadline, child_ply)[0]
+            finally:
+                #Revert the game state back to its origin, also when the search runs out of time
+                undo_move(undo)
+            #Checks for best move, ties keep the first one
+            if current_score > score:
+                score = current_score
+                best_move = move
+                if ply == 0:
+                    self._root_best = (score, move)
+            #Alpha beta option, if turned on, stops looking at the children once one is good enough
+            # that the opponent will avoid this node
+            if alpha_beta:
+                alpha = max(alpha, score)
+                if alpha >= beta:
+                    #remember quiet moves that cause a cutoff to try them early in sibling nodes
+                    if not (enemy >> (move % cells)) & 1:
+                        killers = self.killers[ply]
+                        if move != killers[0]:
+                            killers[1] = killers[0]
+                            killers[0] = move
+                        self.history[move] += depth * depth
                     break
-                #Alpha beta option, if turned on, checks for if node beta <= alpha then breaks off the loop if so
-                # meaning that  it won't check the rest of that nodes children
-                if self.options.alpha_beta == True:
-                    alpha = max(alpha, current_score)
-                    if beta <= alpha:
-                        break           
-            return score, best_move
+
+        if score <= alpha_orig:
+            flag = TTFlag.Upper
+        elif score >= beta:
+            flag = TTFlag.Lower
         else:
-            #next turn incremement
-            score = MAX_HEURISTIC_SCORE
-            best_move = None
-            game2 = self.clone()
-            for move in game2.move_candidates():
-                self.perform_move(move)
-                (current_score, _) = self.minimax(depth - 1, alpha, beta, True, time, game)
-                self = game2.clone()
-                if current_score < score:
-                    score = current_score
-                    best_move = move
-                game2 = self.clone()
-                tot = (datetime.now() - time).total_seconds()
-                if (datetime.now() - time).total_seconds() > self.options.max_time:
-                    break
-                if self.options.alpha_beta == True:
-                    beta = min(beta, current_score)
-                    if beta <= alpha:
+            flag = TTFlag.Exact
+        # always replace, the latest search of a slot is the most relevant one
+        self._tt[self.zkey & TT_MASK] = TTEntry(self.zkey, depth, flag, score, best_move)
+        return score, best_move
+
+    def quiesce(self, alpha, beta, color: int, deadline: int, depth: int) -> int:
+        """Quiescence search: only attacks are searched, up to depth more plies.
+
+        The player to move can always decline to attack, so the heuristic score of the
+        position is a lower bound ("stand pat"). Scores are as in negamax, and like negamax
+        nothing is pruned when alpha beta is turned off.
+        """
+        stats = self.stats
+        stats.nodes += 1
+        if stats.nodes & (CLOCK_CHECK_NODES - 1) == 0 and monotonic_ns() > deadline:
+            raise TimeoutError
+
+        alpha_beta = self.options.alpha_beta
+        score = color * self._evaluate(self)
+        if depth == 0 or self.is_finished() or (alpha_beta and score >= beta):
+            return score
+        alpha = max(alpha, score)
+        cells = self.options.dim ** 2
+        for move in self.order_attacks(self.attack_codes(self._moves_buffer)):
+            undo = self.perform_move_idx(move // cells, move % cells)
+            self.next_turn()
+            try:
+                current_score = -self.quiesce(-beta, -alpha, -color, deadline, depth - 1)
+            finally:
+                self.undo_move(undo)
+            if current_score > score:
+                score = current_score
+                if alpha_beta and score > alpha:
+                    alpha = score
+                    if alpha >= beta:
                         break
-            return score, best_move
+        return score
 
-    # First heuristic given for demo evaluation   
-    def heuristic_e0(self, game: Game):
-        """"Given Heuristic evaluation: e0"""
+    def search_root(self, depth: int, guess: int | None, deadline: int) -> Tuple[int, int | None]:
+        """Negamax search of the root, within an aspiration window around guess when there is one.
+
+        The window is doubled on the side the score falls outside of until the score is inside it.
+        """
+        if guess is None or not self.options.alpha_beta:
+            return self.negamax(depth, MIN_HEURISTIC_SCORE, MAX_HEURISTIC_SCORE, 1, deadline)
+        window = ASPIRATION_WINDOW
+        alpha = max(MIN_HEURISTIC_SCORE, guess - window)
+        beta = min(MAX_HEURISTIC_SCORE, guess + window)
+        while True:
+            (score, move) = self.negamax(depth, alpha, beta, 1, deadline)
+            if score <= alpha and alpha > MIN_HEURISTIC_SCORE:
+                window *= 2
+                alpha = max(MIN_HEURISTIC_SCORE, guess - window)
+            elif score >= beta and beta < MAX_HEURISTIC_SCORE:
+                window *= 2
+                beta = min(MAX_HEURISTIC_SCORE, guess + window)
+            else:
+                return (score, move)
+
+    def search_root_parallel(self, depth: int, deadline: int) -> Tuple[int, int | None]:
+        """Principal variation search of the root with the null window searches done by worker processes (see Options.workers).
+
+        The first move (the best one of the previous depth) is searched here with the full window,
+        the other moves are sent to the workers with a null window around its score, and only the
+        moves that fail high are searched again here with the full window.
+        Raises TimeoutError like negamax.
+        """
+        if self._workers is None:
+            self._workers = ProcessPoolExecutor(max_workers=self.options.workers)
+        self.stats.evaluations_per_depth[0] += 1
+        self.stats.parents += 1
+        entry = self._tt[self.zkey & TT_MASK]
+        tt_move = entry.best_move if entry is not None and entry.key == self.zkey else None
+        moves = self.ordered_move_candidates(0, tt_move)
+        score = self.search_root_child(moves[0], MIN_HEURISTIC_SCORE, MAX_HEURISTIC_SCORE, depth, deadline)
+        best_move = moves[0]
+        self._root_best = (score, best_move)
+        snapshot = self.snapshot()
+        player = self._current_perspective()[0].value
+        futures = [self._workers.submit(search_root_move, snapshot, self.zkey, player, move, depth, score, deadline)
+                   for move in moves[1:]]
+        try:
+            for (move, future) in zip(moves[1:], futures):
+                result = future.result()
+                if result is None:
+                    raise TimeoutError
+                (move_score, stats) = result
+                for (k, count) in enumerate(stats.evaluations_per_depth):
+                    self.stats.evaluations_per_depth[k] += count
+                self.stats.parents += stats.parents
+                self.stats.nodes += stats.nodes
+                #a move failing high beats the first one, ties keep the first one
+                if move_score > score:
+                    move_score = self.search_root_child(move, score, MAX_HEURISTIC_SCORE, depth, deadline)
+                    if move_score > score:
+                        (score, best_move) = (move_score, move)
+                        self._root_best = (score, best_move)
+        finally:
+            for future in futures:
+                future.cancel()
+        # the next depth searches this move first
+        self._tt[self.zkey & TT_MASK] = TTEntry(self.zkey, depth, TTFlag.Exact, score, best_move)
+        return score, best_move
+
+    def search_root_child(self, move: int, alpha: int, beta: int, depth: int, deadline: int) -> int:
+        """Score of a root move searched to depth within the (alpha, beta) window, as in negamax."""
+        cells = self.options.dim ** 2
+        undo = self.perform_move_idx(move // cells, move % cells)
+        self.next_turn()
+        try:
+            return -self.negamax(depth - 1, -beta, -alpha, -1, deadline, 1)[0]
+        finally:
+            self.undo_move(undo)
+
+    def _current_perspective(self) -> Tuple[Player,Player]:
+        """The (player, opponent) pair the heuristics score for: the player controlled by the computer."""
         if self.options.game_type == GameType.CompVsDefender:
-            nplayer = Player.Defender   
-            player = Player.Attacker
-        elif self.options.game_type.name == "AttackerVsComp":
-            nplayer = Player.Attacker   
-            player = Player.Defender
-        elif self.options.game_type == GameType.CompVsComp and game.next_player.name == "Attacker":
-            nplayer = Player.Defender   
-            player = Player.Attacker
-        elif self.options.game_type == GameType.CompVsComp and game.next_player.name == "Defender":
-            nplayer = Player.Attacker   
-            player = Player.Defender
-
-        other = ai = nother = nai = 0
-        for coord, unit in self.player_units(player):
-            if unit.type.name == "AI":
-                ai += 1
-            elif unit is not None:
-                other += 1
-        for coord, unit in self.player_units(nplayer):
-            if unit.type.name == "AI":
-                nai += 1
-            elif unit is not None:
-                nother += 1
+            return (Player.Attacker, Player.Defender)
+        elif self.options.game_type == GameType.AttackerVsComp:
+            return (Player.Defender, Player.Attacker)
+        return (self.next_player, self.next_player.next())
 
+    # First heuristic given for demo evaluation   
+    def heuristic_e0(self, player: Player, nplayer: Player):
+        """"Given Heuristic evaluation: e0"""
+        counts = unit_type_totals(self.type_grid, self.player_grid, None)
+        mine = counts[player.value]
+        theirs = counts[nplayer.value]
+        (ai, nai) = (mine[0], theirs[0])
+        (other, nother) = (sum(mine) - ai, sum(theirs) - nai)
         return (3*other + 9999*ai) - (3*nother + 9999*nai)
     
     #Heuristic (not good) just for futher testing of code functionality, works simply off the units health
-    def heuristic_e1(self, game: Game):
+    def heuristic_e1(self, player: Player, nplayer: Player):
         """"Given Heuristic evaluation: e1"""
-        if self.options.game_type == GameType.CompVsDefender:
-            nplayer = Player.Defender   
-            player = Player.Attacker
-        elif self.options.game_type.name == "AttackerVsComp":
-            nplayer = Player.Attacker   
-            player = Player.Defender
-        elif self.options.game_type == GameType.CompVsComp and game.next_player.name == "Attacker":
-            nplayer = Player.Defender   
-            player = Player.Attacker
-        elif self.options.game_type == GameType.CompVsComp and game.next_player.name == "Defender":
-            nplayer = Player.Attacker   
-            player = Player.Defender
-
-        other = ai = nother = nai = 0
-        for coord, unit in self.player_units(player):
-            if unit.type.name == "AI":
-                ai += unit.health
-            elif unit is not None:
-                other += unit.health
-        for coord, unit in self.player_units(nplayer):
-            if unit.type.name == "AI":
-                nai += unit.health
-            elif unit is not None:
-                nother += unit.health
+        healths = unit_type_totals(self.type_grid, self.player_grid, self.health_grid)
+        mine = healths[player.value]
+        theirs = healths[nplayer.value]
+        (ai, nai) = (mine[0], theirs[0])
+        (other, nother) = (sum(mine) - ai, sum(theirs) - nai)
         return (9*other + 99*ai) - (9*nother + 99*nai)
     
-    def heuristic_e2(self, game: Game):
+    def heuristic_e2(self, player: Player, nplayer: Player):
         """"Given Heuristic evaluation: e2"""
+        return self.heuristic_e2_for(player)(self)
 
-        if self.options.game_type == GameType.CompVsDefender:
-            nplayer = Player.Defender   
-            player = Player.Attacker
-        elif self.options.game_type.name == "AttackerVsComp":
-            nplayer = Player.Attacker   
-            player = Player.Defender
-        elif self.options.game_type == GameType.CompVsComp and game.next_player.name == "Attacker":
-            nplayer = Player.Defender   
-            player = Player.Attacker
-        elif self.options.game_type == GameType.CompVsComp and game.next_player.name == "Defender":
-            nplayer = Player.Attacker   
-            player = Player.Defender
-
-        # First part of the heuristic is assigning material balance: health check for pieces
-        other = nother = ai = nai = v = nv = p = np = 0
-        combat = ncombat = 0
-        ai_move = nai_move = 0
-        closing = nclosing = 0
-
-        for coord, unit in self.player_units(player):
-            
-            if unit.type.name == "AI":
-                for coords in coord.iter_range(1) :
-                    unitDst = self.get(coords)
-                    if unitDst is not None and unitDst.player != unit.player.name:
-                        closing -= 2
-
-                for coords in coord.iter_range(2):
-                    unitDst = self.get(coords)
-                    if unitDst is not None and unitDst.player.name != unit.player.name:
-                        closing -= 1
-
-            if self.in_combat(coord):
-                combat += 1
-
-            for coords in coord.iter_range(1):
-                unitDst = self.get(coords)
-                if unitDst is not None:
-                    other += 1
-
-            if unit.type.name == "AI":
-                ai = 1000
-            elif unit.type.name == "Virus" or unit.type.name == "Tech":
-                v += 2 * unit.health
-            elif unit is not None:
-                other += unit.health
-
-        for coord, unit in self.player_units(nplayer):
-
-            if unit.type.name == "AI":
-                for coords in coord.iter_range(1):
-                    unitDst = self.get(coords)
-                    if unitDst is not None and unitDst.player.name != unit.player.name:
-                        closing -= 2
-
-                for coords in coord.iter_range(2):
-                    unitDst = self.get(coords)
-                    if unitDst is not None and unitDst.player.name != unit.player.name:
-                        closing -= 1
-
-            if self.in_combat(coord):
-                ncombat += 1
-
-            for coords in coord.iter_range(1):
-                unitDst = self.get(coords)
-                if unitDst is not None:
-                    other += 1
-
-            if unit.type.name == "AI":
-                nai = 1000
-            elif unit.type.name == "Virus" or unit.type.name == "Tech":
-                nv += 2 * unit.health
-            elif unit is not None:
-                nother += unit.health
-
-        #Second part of the heuristic is evaluating how many open moves you get
-        moves = nmoves = 0
-        for move in self.move_candidates2(player):
-            moves += 1
-        for move in self.move_candidates2(nplayer):
-            moves += 1
-
-        #Third part allow for the AI to move
-
-        heur = (other + v + p + ai  + moves + ai_move + combat + closing) - (nother + nv + np + nai  + nmoves + nai_move + ncombat + nclosing)
-        return heur
+    def heuristic_e2_for(self, player: Player) -> Callable[[Game], int]:
+        """heuristic_e2 specialized for player: a function of the game with the player and board constants bound.
+
+        The mobility part is the same for both players (moves of the next player plus the self-destructs
+        of the other one), so it needs no perspective.
+        """
+        me = player.value
+        dim = self.options.dim
+        def evaluate(game: Game) -> int:
+            occupancy = (game.occ_attacker, game.occ_defender)
+            mover = game.next_player.value
+            return (eval_e2_static(game.type_grid, game.health_grid, occupancy, dim, me)
+                    + count_moves_static(game.by_type, game.damaged, occupancy, dim, mover)
+                    + occupancy[1-mover].bit_count())
+        return evaluate
                   
+    def prepare_search(self, player: Player):
+        """Reset the search tables for a new search scoring positions for player."""
+        # scores are relative to the player to move at the root, so entries can't be reused across turns
+        self._tt = [None] * TT_SIZE
+        self._evaluate = self.heuristic_e2_for(player)
+        self.killers = [[None, None] for _ in range(self.options.max_depth + 1)]
+        self.history = [0] * (self.options.dim ** 4)
+        self._root_best = None
+        self.stats.reserve_depth(self.options.max_depth)
+
     def suggest_move(self, file) -> CoordPair | None:
-        """Suggest the next move using minimax alpha beta. TODO: REPLACE RANDOM_MOVE WITH PROPER GAME LOGIC!!!"""
-        start_time = datetime.now()
-        ngame = self.clone()   
-        eval = 0     
-        (score, move) = ngame.minimax(self.options.max_depth, MIN_HEURISTIC_SCORE, MAX_HEURISTIC_SCORE, True, start_time, self)
-        self.stats.minimax_entry = 0
-
-        elapsed_seconds = (datetime.now() - start_time).total_seconds()
+        """Suggest the next move using negamax alpha beta."""
+        start_time = monotonic_ns()
+        # the search stops a little early, it only notices the deadline at its next clock read
+        budget = max(self.options.max_time - SEARCH_TIME_MARGIN, self.options.max_time * 0.5)
+        deadline = start_time + int(budget * 1e9)
+        # a deeper iteration started this late would only be thrown away at the deadline
+        soft_deadline = start_time + int(budget * 0.9e9)
+        self.prepare_search(self._current_perspective()[0])
+        # Iterative deepening: each depth seeds the move ordering of the next one through the
+        # transposition table, and the deepest depth completed within the time limit is kept
+        score = 0
+        move = None
+        for depth in range(1, self.options.max_depth+1):
+            # depth 1 is always started, there is no move to fall back on yet
+            if move is not None and monotonic_ns() > soft_deadline:
+                break
+            try:
+                if self.options.workers > 1 and depth > 1:
+                    (depth_score, depth_move) = self.search_root_parallel(depth, deadline)
+                else:
+                    (depth_score, depth_move) = self.search_root(depth, score if move is not None else None, deadline)
+            except TimeoutError:
+                # the partially searched depth is discarded, negamax has already undone its moves,
+                # unless it was depth 1: its best move so far beats no search at all
+                if move is None and self._root_best is not None:
+                    (score, move) = (self._root_best[0], self.move_from_code(self._root_best[1]))
+                break
+            if depth_move is not None:
+                (score, move) = (depth_score, self.move_from_code(depth_move))
+        if move is None:
+            # out of time before any root move was searched, play the most promising move that doesn't
+            # self-destruct, or at least doesn't self-destruct the AI
+            cells = self.options.dim ** 2
+            codes = self.ordered_move_candidates(0)
+            codes = ([code for code in codes if code // cells != code % cells]
+                     or [code for code in codes if self.type_grid[code // cells] != UnitType.AI.value]
+                     or codes)
+            if codes:
+                move = self.move_from_code(codes[0])
+
+        elapsed_seconds = (monotonic_ns() - start_time) / 1e9
         self.stats.total_seconds += elapsed_seconds
+        # the trace is written in one go, main flushes it at the end of the turn
+        trace = []
         score_str = f"Heuristic score: {score}\n"
         print(score_str, end='')
-        file.write(score_str)
+        trace.append(score_str)
 
-        total_evals = sum(self.stats.evaluations_per_depth.values())
+        total_evals = sum(self.stats.evaluations_per_depth)
         cumulative_evals_str = f"Cumulative evals: {total_evals}\n"
         print(cumulative_evals_str, end='')
-        file.write(cumulative_evals_str)
+        trace.append(cumulative_evals_str)
 
-        evals_per_depth_str = "Evals per depth: "
-        for k in sorted(self.stats.evaluations_per_depth.keys()):
-            if k == self.options.max_depth:
-                break
-            evals_per_depth_str += f"{self.options.max_depth - k}:{self.stats.evaluations_per_depth[k]} "
+        # counts by depth from the root (which is left out)
+        depth_counts = [(depth, count) for (depth, count) in enumerate(self.stats.evaluations_per_depth) if depth > 0 and count]
+        evals_per_depth_str = "Evals per depth: " + ''.join(f"{depth}:{count} " for (depth, count) in depth_counts)
         print(evals_per_depth_str, end='')
-        file.write(evals_per_depth_str + '\n')
+        trace.append(evals_per_depth_str + '\n')
 
-        cumulative_percentage_str = "Cumulative % evals per depth: "
-        for k in sorted(self.stats.evaluations_per_depth.keys()):
-            if k == self.options.max_depth:
-                break
-            percentage = (self.stats.evaluations_per_depth[k] / total_evals) * 100
-            cumulative_percentage_str += f"{self.options.max_depth - k}:{percentage:.1f}% "
+        cumulative_percentage_str = "Cumulative % evals per depth: " + ''.join(
+            f"{depth}:{(count / total_evals) * 100:.1f}% " for (depth, count) in depth_counts)
         print(cumulative_percentage_str, end='')
-        file.write(cumulative_percentage_str + '\n')
-
-        branching_factor = self.stats.evaluations_per_depth[0] / self.stats.evaluations_per_depth[1]
+        trace.append(cumulative_percentage_str + '\n')
+
+        # average number of moves searched per node that searched its moves, iterative deepening
+        # searches the same plies several times so a ratio of two plies would mix iterations
+        # (no node was expanded when time ran out first, or max_depth is 0)
+        children = sum(self.stats.evaluations_per_depth[1:])
+        parents = self.stats.parents
+        branching_factor = children / parents if parents else 0.0
         branching_factor_str = f"Branching factor: {branching_factor:.1f}\n"
         print(branching_factor_str)
-        file.write(branching_factor_str)
+        trace.append(branching_factor_str)
 
-        file.flush()
+        file.write(''.join(trace))
 
         if self.stats.total_seconds > 0:
             print(f"Eval perf.: {total_evals/self.stats.total_seconds/1000:0.1f}k/s")
         print(f"Elapsed time: {elapsed_seconds:0.1f}s")
         return move
 
+    def broker_session(self) -> requests.Session:
+        """HTTP session to the game broker, created on first use."""
+        if requests is None:
+            raise RuntimeError("the requests package is needed to play via a game broker")
+        if self._broker_session is None:
+            self._broker_session = requests.Session()
+            self._broker_session.mount(self.options.broker, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        return self._broker_session
+
+    def wait_broker_post(self):
+        """Wait until the move being posted to the broker (if any) is sent."""
+        if self._broker_post is not None:
+            self._broker_post.result()
+            self._broker_post = None
+
     def post_move_to_broker(self, move: CoordPair):
-        """Send a move to the game broker."""
+        """Send a move to the game broker, in the background so that the game can go on meanwhile."""
         if self.options.broker is None:
             return
         data = {
@@ -821,10 +1360,17 @@ class Game:
             "to": {"row": move.dst.row, "col": move.dst.col},
             "turn": self.turns_played
         }
+        self.wait_broker_post()
+        if self._broker_pool is None:
+            self._broker_pool = ThreadPoolExecutor(max_workers=1)
+        self._broker_post = self._broker_pool.submit(self._post_to_broker, data)
+
+    def _post_to_broker(self, data: dict):
+        """Send move data to the game broker and report errors."""
         try:
-            r = requests.post(self.options.broker, json=data)
+            r = self.broker_session().post(self.options.broker, json=data, timeout=BROKER_TIMEOUT)
             if r.status_code == 200 and r.json()['success'] and r.json()['data'] == data:
-                # print(f"Sent move to broker: {move}")
+                # print(f"Sent move to broker: {data}")
                 pass
             else:
                 print(f"Broker error: status code: {r.status_code}, response: {r.json()}")
@@ -836,8 +1382,10 @@ class Game:
         if self.options.broker is None:
             return None
         headers = {'Accept': 'application/json'}
+        # our own move has to reach the broker before polling for the answer to it
+        self.wait_broker_post()
         try:
-            r = requests.get(self.options.broker, headers=headers)
+            r = self.broker_session().get(self.options.broker, headers=headers, timeout=BROKER_TIMEOUT)
             if r.status_code == 200 and r.json()['success']:
                 data = r.json()['data']
                 if data is not None:
@@ -861,6 +1409,170 @@ class Game:
             print(f"Broker error: {error}")
         return None
 
+    def shutdown(self):
+        """Send the move being posted to the broker, then stop the broker thread and the search workers."""
+        self.wait_broker_post()
+        if self._broker_pool is not None:
+            self._broker_pool.shutdown()
+            self._broker_pool = None
+        if self._broker_session is not None:
+            self._broker_session.close()
+            self._broker_session = None
+        if self._workers is not None:
+            self._workers.shutdown(cancel_futures=True)
+            self._workers = None
+
+##############################################################################################################
+
+# the game and search tables of a worker process, kept for the following tasks of the same search
+_worker_search : Tuple[Tuple[int, int, int], Game] | None = None
+
+def search_root_move(snapshot: Tuple[Options, int, int, list[Tuple[int,int,int,int]]], zkey: int, player: int, move: int, depth: int, alpha: int, deadline: int) -> Tuple[int, Stats] | None:
+    """Worker process side of Game.search_root_parallel: null window search of a root move to depth.
+
+    Returns the score, above alpha only if the move beats alpha, and the stats of the search,
+    or None if the deadline passed first.
+    """
+    global _worker_search
+    # a task started after the deadline would search a whole clock check interval for nothing
+    if monotonic_ns() > deadline:
+        return None
+    # the transposition table filled by the earlier tasks and depths of the same search stays valid
+    key = (zkey, snapshot[2], player)
+    if _worker_search is None or _worker_search[0] != key:
+        game = Game.from_snapshot(snapshot)
+        game.prepare_search(Player(player))
+        _worker_search = (key, game)
+    game = _worker_search[1]
+    game.stats = Stats()
+    game.stats.reserve_depth(game.options.max_depth)
+    try:
+        score = game.search_root_child(move, alpha, alpha + 1, depth, deadline)
+    except TimeoutError:
+        return None
+    return (score, game.stats)
+
+##############################################################################################################
+
+def unit_type_totals(type_grid: list[int], player_grid: list[int], health_grid: list[int] | None) -> list[list[int]]:
+    """Number of units (or their total health if health_grid is given) per player and unit type."""
+    totals = [[0]*5, [0]*5]
+    if health_grid is None:
+        for (t, p) in zip(type_grid, player_grid):
+            if p >= 0:
+                totals[p][t] += 1
+    else:
+        for (t, p, h) in zip(type_grid, player_grid, health_grid):
+            if p >= 0:
+                totals[p][t] += h
+    return totals
+
+def eval_e2_static(type_grid: list[int], health_grid: list[int], occupancy: Tuple[int,int], dim: int, me: int) -> int:
+    """Board part of heuristic e2 from player me's point of view.
+
+    Works on the flat grids and the occupancy bitboard of each player (indexed by player value).
+    """
+    (range1, range2) = range_masks(dim)
+    adjacent = adjacent_masks(dim)
+    occupied = occupancy[0] | occupancy[1]
+    totals = [0, 0]
+    for p in (0, 1):
+        enemy = occupancy[1-p]
+        value = 0
+        bb = occupancy[p]
+        while bb:
+            lsb = bb & -bb
+            bb ^= lsb
+            idx = lsb.bit_length() - 1
+            t = type_grid[idx]
+            # Material: the AI is worth a fixed amount, Virus and Tech count their health twice
+            if t == 0:
+                # Closing: -2 per enemy unit within 1 cell of the AI, -1 per enemy unit within 2 cells
+                value += 1000 - 2*(enemy & range1[idx]).bit_count() - (enemy & range2[idx]).bit_count()
+            elif t == 1 or t == 2:
+                value += 2 * health_grid[idx]
+            else:
+                value += health_grid[idx]
+            # Combat: +1 if an enemy unit is adjacent
+            if enemy & adjacent[idx]:
+                value += 1
+            # Density: occupied cells around (and including) the unit
+            value += (occupied & range1[idx]).bit_count()
+        totals[p] = value
+    return totals[me] - totals[1-me]
+
+def count_moves_static(by_type: list[int], damaged: int, occupancy: Tuple[int,int], dim: int, mover: int) -> int:
+    """Number of valid moves of player mover (see Game.is_valid_move) when it is its turn.
+
+    Works on bitboards only: the units of each type, the damaged units and the occupancy of each
+    player (indexed by player value). Moves are counted one direction at a time, for all units at once.
+    """
+    shifts = direction_shifts(dim)
+    own = occupancy[mover]
+    enemy = occupancy[1-mover]
+    empty = ((1 << dim*dim) - 1) & ~(own | enemy)
+    restricted = 0
+    for t in RESTRICTED_TYPE_VALUES:
+        restricted |= by_type[t]
+    restricted &= own
+    unrestricted = own & ~restricted
+    # one self-destruct per unit
+    count = own.bit_count()
+    engaged = 0
+    for (shift, mask) in shifts.values():
+        if shift < 0:
+            attackers = own & (enemy << -shift) & mask
+            movers = unrestricted & (empty << -shift) & mask
+        else:
+            attackers = own & (enemy >> shift) & mask
+            movers = unrestricted & (empty >> shift) & mask
+        engaged |= attackers
+        count += attackers.bit_count() + movers.bit_count()
+    # AI, Firewall and Program can only move forward, and not while engaged in combat
+    free = restricted & ~engaged
+    for delta in FORWARD_DELTAS[mover]:
+        (shift, mask) = shifts[delta]
+        if shift < 0:
+            count += (free & (empty << -shift) & mask).bit_count()
+        else:
+            count += (free & (empty >> shift) & mask).bit_count()
+    # repairs are only valid if they restore some health
+    for (src, dst) in REPAIR_PAIRS:
+        repairers = own & by_type[src]
+        patients = own & by_type[dst] & damaged
+        if repairers and patients:
+            for (shift, mask) in shifts.values():
+                if shift < 0:
+                    count += (repairers & (patients << -shift) & mask).bit_count()
+                else:
+                    count += (repairers & (patients >> shift) & mask).bit_count()
+    return count
+
+def check_move_rules(games: int = 100, turns: int = 60, seed: int = 0):
+    """Check on random games that is_valid_move, move_candidates_codes and count_moves_static agree.
+
+    The move rules are implemented by all three, run this after changing any of them:
+    python -c "import ai_wargame; ai_wargame.check_move_rules()"
+    Raises AssertionError on the first position where they disagree.
+    """
+    rng = random.Random(seed)
+    for _ in range(games):
+        game = Game(options=Options(game_type=GameType.CompVsComp))
+        dim = game.options.dim
+        moves = move_table(dim)
+        for _ in range(turns):
+            if game.is_finished():
+                break
+            codes = game.move_candidates_codes()
+            valid = [code for (code, move) in enumerate(moves) if game.is_valid_move(move)]
+            if sorted(codes) != valid:
+                raise AssertionError(f"move_candidates_codes disagrees with is_valid_move:\n{game}")
+            occupancy = (game.occ_attacker, game.occ_defender)
+            if count_moves_static(game.by_type, game.damaged, occupancy, dim, game.next_player.value) != len(codes):
+                raise AssertionError(f"count_moves_static disagrees with move_candidates_codes:\n{game}")
+            game.perform_move(moves[rng.choice(codes)])
+            game.next_turn()
+
 ##############################################################################################################
 
 def main():
@@ -872,6 +1584,7 @@ def main():
     parser.add_argument('--max_time', type=float, help='maximum search time')
     parser.add_argument('--game_type', type=str, default="auto", help='game type: auto|attacker|defender|manual')
     parser.add_argument('--broker', type=str, help='play via a game broker')
+    parser.add_argument('--workers', type=int, help='processes searching the root moves in parallel (at most one per CPU)')
     args = parser.parse_args()
 
     # parse the game type
@@ -894,6 +1607,9 @@ def main():
         options.max_time = args.max_time
     if args.broker is not None:
         options.broker = args.broker
+    if args.workers is not None:
+        # workers sharing a CPU only add their overhead to the search
+        options.workers = min(args.workers, os.cpu_count() or 1)
 
     # create a new game
     game = Game(options=options)
@@ -908,33 +1624,36 @@ def main():
     file.write("--Max number of turns: " + str(options.max_turns)+ "\n")
     file.write("--Is alpha-beta on : " + str(options.alpha_beta)+ "\n")
     file.write("--Play mode: " + str(game.options.game_type.name)+ "\n\n")
-    file.flush()
-    # the main game loop
-    while True:
-        winner = game.has_winner()
-        if winner is not None:
-            print(f"{winner.name} wins!")
-            file.write(f"{winner.name} wins!")
-            file.flush()
-            break
-        if game.options.game_type == GameType.AttackerVsDefender:
-            game.human_turn(file)
-        elif game.options.game_type == GameType.AttackerVsComp and game.next_player == Player.Attacker:
-            game.human_turn(file)
-        elif game.options.game_type == GameType.CompVsDefender and game.next_player == Player.Defender:
-            game.human_turn(file)
-        else:
-            player = game.next_player
-            move = game.computer_turn(file)
-            if move is not None:
-                game.post_move_to_broker(move)
+    # the main game loop, the broker thread and search workers are stopped however it ends
+    try:
+        while True:
+            winner = game.has_winner()
+            if winner is not None:
+                print(f"{winner.name} wins!")
+                file.write(f"{winner.name} wins!")
+                file.flush()
+                break
+            if game.options.game_type == GameType.AttackerVsDefender:
+                game.human_turn(file)
+            elif game.options.game_type == GameType.AttackerVsComp and game.next_player == Player.Attacker:
+                game.human_turn(file)
+            elif game.options.game_type == GameType.CompVsDefender and game.next_player == Player.Defender:
+                game.human_turn(file)
             else:
-                print("Computer doesn't know what to do!!!")
-                exit(1)
-        print()
-        print(game)
-        file.write("\n" + str(game) + "\n")
-        file.flush()
+                player = game.next_player
+                move = game.computer_turn(file)
+                if move is not None:
+                    game.post_move_to_broker(move)
+                else:
+                    print("Computer doesn't know what to do!!!")
+                    file.flush()
+                    exit(1)
+            print()
+            print(game)
+            file.write("\n" + str(game) + "\n")
+            file.flush()
+    finally:
+        game.shutdown()
 
 ##############################################################################################################
 